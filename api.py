@@ -1,14 +1,33 @@
-from fastapi import FastAPI, HTTPException, Depends, Body
+from fastapi import FastAPI, HTTPException, Depends, Body, BackgroundTasks, Query, Response
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, ConfigDict, ValidationError, field_validator
 from typing import List, Optional, Dict, Any
-import openai
+from contextlib import asynccontextmanager
+from collections import OrderedDict
+from openai import AsyncOpenAI, NotFoundError, RateLimitError, APIConnectionError, InternalServerError
+from cachetools import TTLCache
+from aiolimiter import AsyncLimiter
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+import aiosqlite
+import asyncio
+import hashlib
+import httpx
+import numpy as np
+import redis.asyncio as redis
 import os
-import random
+import secrets
 import json
-from datetime import datetime, timedelta
+import logging
+import time
+from datetime import datetime
+from string import Template
 from dotenv import load_dotenv
 
+logger = logging.getLogger(__name__)
+
 # Load environment variables
 load_dotenv()
 api_key = os.getenv("OPENAI_API_KEY")
@@ -18,13 +37,43 @@ api_key = os.getenv("OPENAI_API_KEY")
 if not api_key:
     raise ValueError("Missing OpenAI API key")
 
-openai.api_key = api_key
-client = openai
+# Shared connection pool so concurrent requests reuse open connections
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_keepalive_connections=100, max_connections=200)
+)
+client = AsyncOpenAI(api_key=api_key, http_client=http_client)
+# For calls wrapped in openai_retry, which backs off outside the concurrency limits
+no_retry_client = client.with_options(max_retries=0)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global db
+    db = await aiosqlite.connect(EMAILS_DB)
+    db.row_factory = aiosqlite.Row
+    await init_db(db)
+    load_semantic_cache()
+    save_task = asyncio.create_task(save_semantic_cache_periodically())
+    # Open a pooled TLS connection to OpenAI before the first user request needs it
+    # (retrieving the model is free, unlike a completion, and every worker does this)
+    try:
+        await client.models.retrieve(DEFAULT_AI_MODEL, timeout=OPENAI_WARMUP_TIMEOUT)
+    except Exception as e:
+        logger.warning("OpenAI connection warm-up failed: %s", e)
+    yield
+    save_task.cancel()
+    await save_semantic_cache()
+    await db.close()
+    # Close pooled connections on shutdown
+    await client.close()
+    if redis_client:
+        await redis_client.aclose()
 
 app = FastAPI(
     title="Pepsales AI API",
     description="API for generating and managing cold emails",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 
@@ -34,21 +83,91 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 # Rate limiting configuration
 RATE_LIMIT_FILE = "rate_limits.json"
 MAX_REQUESTS_PER_DAY = 15
 MAX_REQUESTS_PER_HOUR = 5
+# Multi-email calls count every email, so they can never exceed the hourly limit
+MAX_EMAILS_PER_CALL = MAX_REQUESTS_PER_HOUR
+
+# Redis is used for rate limiting when configured, otherwise RATE_LIMIT_FILE
+REDIS_URL = os.getenv("REDIS_URL")
+redis_client = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
 
 # Default AI model
 DEFAULT_AI_MODEL = "gpt-3.5-turbo"
+# Deterministic sampling, so cached responses match what a fresh call would return
+DEFAULT_TEMPERATURE = 0
+OPENAI_WARMUP_TIMEOUT = 5
+SYSTEM_PROMPT = "You write persuasive and personalized B2B cold emails."
+
+# Email generation prompt, compiled once at import
+PROMPT_TEMPLATE = Template("""
+You are an expert cold email copywriter and B2B personalization strategist.
+
+Write a highly personalized cold email from $sender_company to $person_name, the $role at $target_company in the $industry industry, based on the following subject line:
+
+Subject: $email_subject
+
+The email should:
+- Use a $tone tone and be $length in length
+- Start with a hook that's personalized and relevant to $target_company and their industry
+- Explain how $sender_company's platform can solve pain points like lead qualification, demo personalization, or sales insights
+- Show why this is useful for someone in the role of $role
+- Align with the theme of the subject line
+- End with a friendly CTA to continue the conversation
+
+$custom_instructions
+
+Return only the email body. Do NOT include signature or re-state the subject.
+""")
+
+# OpenAI throughput limits shared by every request in this process
+OPENAI_MAX_CONCURRENT_REQUESTS = 20
+OPENAI_REQUESTS_PER_MINUTE = 500
+openai_semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENT_REQUESTS)
+openai_limiter = AsyncLimiter(OPENAI_REQUESTS_PER_MINUTE, 60)
+
+# Retry transient OpenAI failures with jittered exponential backoff
+openai_retry = retry(
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(5),
+    retry=retry_if_exception_type((RateLimitError, APIConnectionError, InternalServerError)),
+    reraise=True
+)
 
-# In-memory storage for emails (in production this would be a database)
-saved_emails = []
+# Exact-match response cache (only safe while DEFAULT_TEMPERATURE is 0)
+response_cache = TTLCache(maxsize=10_000, ttl=86400)
+response_cache_lock = asyncio.Lock()
+
+# Semantic cache configuration. Each worker keeps its own cache and saves it over
+# the same file, so the last worker to save wins and all workers load that at startup
+SEMANTIC_CACHE_FILE = "semantic_cache.npz"
+EMBEDDING_MODEL = "text-embedding-3-small"
+SEMANTIC_CACHE_THRESHOLD = 0.92
+SEMANTIC_CACHE_MAX_IDENTITIES = 2000
+SEMANTIC_CACHE_MAX_PER_IDENTITY = 5
+SEMANTIC_CACHE_SAVE_INTERVAL = 300
+
+# Batch API statuses after which no more results will appear
+BATCH_FINISHED_STATUSES = ("completed", "expired", "cancelled", "failed")
+
+# SQLite storage for saved emails, opened in lifespan
+EMAILS_DB = "emails.db"
+MAX_PAGE_SIZE = 100
+db = None
+
+# Semantic cache: recipient identity -> (unit-normalised embeddings of the
+# subject and instructions, the emails generated for them), least recently used first
+semantic_cache = OrderedDict()
 
 # Request models
 class EmailGenerationRequest(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    
     sender_company: str
     target_company: str
     industry: str
@@ -59,11 +178,33 @@ class EmailGenerationRequest(BaseModel):
     length: str = "Concise"
     custom_instructions: Optional[str] = None
     session_id: Optional[str] = None
+    
+    @field_validator("sender_company", "target_company", "person_name", "role", "email_subject")
+    @classmethod
+    def check_required(cls, value: str):
+        if not value:
+            raise ValueError("All fields are required")
+        return value
 
 class EmailResponse(BaseModel):
     email_text: str
     subject: str
 
+class BatchJobResponse(BaseModel):
+    batch_id: str
+    status: str
+
+class BatchEmailFailure(BaseModel):
+    index: int
+    subject: str
+    error: str
+
+class BatchResultResponse(BaseModel):
+    batch_id: str
+    status: str
+    emails: List[EmailResponse]
+    failed: List[BatchEmailFailure] = []
+
 class SavedEmail(BaseModel):
     id: str
     date: str
@@ -72,6 +213,57 @@ class SavedEmail(BaseModel):
     subject: str
     content: str
 
+# Database functions
+async def init_db(conn):
+    """Create the emails table and indexes if they don't exist"""
+    # WAL lets analytics and history reads run alongside inserts
+    await conn.execute("PRAGMA journal_mode=WAL")
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS emails (
+            id TEXT PRIMARY KEY,
+            date TEXT,
+            recipient TEXT,
+            company TEXT,
+            subject TEXT,
+            content TEXT,
+            word_count INT,
+            created_ts REAL,
+            day TEXT
+        )
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_emails_day ON emails(day)")
+    # Keyset pagination order for saved emails
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_emails_created_ts_id ON emails(created_ts, id)")
+    # Covering index so top-companies grouping scans the index instead of sorting the table
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_emails_company ON emails(company)")
+    # Recipient details for each line of a submitted OpenAI batch
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS batch_requests (
+            batch_id TEXT,
+            custom_id TEXT,
+            recipient TEXT,
+            company TEXT,
+            subject TEXT,
+            PRIMARY KEY (batch_id, custom_id)
+        )
+    """)
+    await conn.commit()
+
+async def persist_email(email: Dict[str, Any]):
+    """Save a generated email to history, ignoring ids that already exist"""
+    created_ts = time.time()
+    created_at = datetime.fromtimestamp(created_ts)
+    # Word count and day are stored once here so analytics never recompute them
+    await db.execute(
+        "INSERT OR IGNORE INTO emails (id, date, recipient, company, subject, content, word_count, created_ts, day) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (email["id"], created_at.strftime("%Y-%m-%d %H:%M"),
+         email["recipient"], email["company"], email["subject"],
+         email["content"], len(email["content"].split()), created_ts,
+         created_at.strftime("%Y-%m-%d"))
+    )
+    await db.commit()
+
 # Rate limiting functions
 def load_rate_limits():
     """Load rate limit data from file"""
@@ -88,147 +280,330 @@ def save_rate_limits(data):
     with open(RATE_LIMIT_FILE, 'w') as f:
         json.dump(data, f)
 
-def check_rate_limit(session_id: str):
-    """Check if the current user is rate limited"""
-    # Get current time
-    now = datetime.now()
-    today = now.strftime("%Y-%m-%d")
-    hour = now.strftime("%Y-%m-%d-%H")
+def check_rate_limit(session_id: str, count: int = 1, now: Optional[int] = None):
+    """Check if the current user can make count requests and count them if so"""
+    # Get current day and hour buckets (JSON object keys must be strings)
+    now = now or int(time.time())
+    today = str(now // 86400)
+    hour = str(now // 3600)
     
     # Load existing rate limits
     rate_limits = load_rate_limits()
     
-    # Clean up old entries (older than 1 day)
-    daily_limits = {}
-    for day, users in rate_limits["daily"].items():
-        day_dt = datetime.strptime(day, "%Y-%m-%d")
-        if (now - day_dt).days < 1:
-            daily_limits[day] = users
-    rate_limits["daily"] = daily_limits
-    
-    # Clean up old hourly entries (older than 1 hour)
-    hourly_limits = {}
-    for h, users in rate_limits["hourly"].items():
-        hour_dt = datetime.strptime(h, "%Y-%m-%d-%H")
-        if (now - hour_dt).total_seconds() < 3600:
-            hourly_limits[h] = users
-    rate_limits["hourly"] = hourly_limits
-    
-    # Initialize if needed
-    if today not in rate_limits["daily"]:
-        rate_limits["daily"][today] = {}
-    if hour not in rate_limits["hourly"]:
-        rate_limits["hourly"][hour] = {}
+    # Drop every bucket except the current day and hour
+    rate_limits["daily"] = {today: rate_limits["daily"].get(today, {})}
+    rate_limits["hourly"] = {hour: rate_limits["hourly"].get(hour, {})}
     
     # Get current counts
     daily_count = rate_limits["daily"][today].get(session_id, 0)
     hourly_count = rate_limits["hourly"][hour].get(session_id, 0)
     
     # Check if limits are exceeded
-    if daily_count >= MAX_REQUESTS_PER_DAY:
+    if daily_count + count > MAX_REQUESTS_PER_DAY:
         return False, f"Request limit exceeded. Please try again tomorrow."
-    if hourly_count >= MAX_REQUESTS_PER_HOUR:
+    if hourly_count + count > MAX_REQUESTS_PER_HOUR:
         return False, f"Request limit exceeded. Please try again later."
     
+    # Increment counters and save updated limits in the same pass
+    rate_limits["daily"][today][session_id] = daily_count + count
+    rate_limits["hourly"][hour][session_id] = hourly_count + count
+    save_rate_limits(rate_limits)
+    
     return True, ""
 
-def increment_rate_limit(session_id: str):
-    """Increment the rate limit counters for the current user"""
-    # Get current time
-    now = datetime.now()
-    today = now.strftime("%Y-%m-%d")
-    hour = now.strftime("%Y-%m-%d-%H")
+async def check_redis_rate_limit(session_id: str, count: int = 1, now: Optional[int] = None):
+    """Atomically count requests against the user's Redis counters"""
+    now = now or int(time.time())
+    daily_key = f"rl:d:{now // 86400}:{session_id}"
+    hourly_key = f"rl:h:{now // 3600}:{session_id}"
     
-    # Load existing rate limits
-    rate_limits = load_rate_limits()
+    pipe = redis_client.pipeline()
+    pipe.incrby(daily_key, count)
+    pipe.expire(daily_key, 86400)
+    pipe.incrby(hourly_key, count)
+    pipe.expire(hourly_key, 3600)
+    daily_count, _, hourly_count, _ = await pipe.execute()
     
-    # Initialize if needed
-    if today not in rate_limits["daily"]:
-        rate_limits["daily"][today] = {}
-    if hour not in rate_limits["hourly"]:
-        rate_limits["hourly"][hour] = {}
+    if daily_count > MAX_REQUESTS_PER_DAY or hourly_count > MAX_REQUESTS_PER_HOUR:
+        # Rejected requests don't count towards the limit
+        pipe = redis_client.pipeline()
+        pipe.decrby(daily_key, count)
+        pipe.decrby(hourly_key, count)
+        await pipe.execute()
+        if daily_count > MAX_REQUESTS_PER_DAY:
+            return False, "Request limit exceeded. Please try again tomorrow."
+        return False, "Request limit exceeded. Please try again later."
     
-    # Increment counters
-    rate_limits["daily"][today][session_id] = rate_limits["daily"][today].get(session_id, 0) + 1
-    rate_limits["hourly"][hour][session_id] = rate_limits["hourly"][hour].get(session_id, 0) + 1
+    return True, ""
+
+async def enforce_rate_limit(session_id: str, count: int = 1, now: Optional[int] = None):
+    """Check the user's rate limit and count the requests if all are allowed"""
+    if redis_client:
+        return await check_redis_rate_limit(session_id, count, now)
+    return check_rate_limit(session_id, count, now)
+
+async def refund_rate_limit(session_id: str, count: int, now: int):
+    """Uncount requests that were counted at now but never served"""
+    if redis_client:
+        pipe = redis_client.pipeline()
+        pipe.decrby(f"rl:d:{now // 86400}:{session_id}", count)
+        pipe.decrby(f"rl:h:{now // 3600}:{session_id}", count)
+        await pipe.execute()
+        return
     
-    # Save updated limits
+    rate_limits = load_rate_limits()
+    for period, bucket in (("daily", str(now // 86400)), ("hourly", str(now // 3600))):
+        users = rate_limits[period].get(bucket, {})
+        if session_id in users:
+            users[session_id] = max(0, users[session_id] - count)
     save_rate_limits(rate_limits)
 
+def shared_session_id(requests: List[EmailGenerationRequest]):
+    """Return the one session a multi-email call is counted against"""
+    session_ids = {request.session_id for request in requests if request.session_id}
+    if len(session_ids) > 1:
+        raise HTTPException(status_code=400, detail="All emails must share one session_id")
+    return session_ids.pop() if session_ids else secrets.token_urlsafe(8)
+
+# Semantic cache functions
+def semantic_cache_identity(request: EmailGenerationRequest):
+    """Return the fields a cached email must match exactly to be reused"""
+    # Names and companies are only a few words of a long prompt, so they can't
+    # be left to embedding similarity without mixing up recipients
+    return "\x1f".join([
+        request.sender_company, request.target_company, request.person_name,
+        request.role, request.industry, request.tone.lower(), request.length.lower()
+    ])
+
+def semantic_cache_text(request: EmailGenerationRequest):
+    """Return the free-text part of a request that is compared by similarity"""
+    return f"Subject: {request.email_subject}\n{request.custom_instructions or ''}".strip()
+
+def load_semantic_cache():
+    """Load cached embeddings and responses from file"""
+    if os.path.exists(SEMANTIC_CACHE_FILE):
+        try:
+            with np.load(SEMANTIC_CACHE_FILE) as data:
+                identities, responses = json.loads(data["texts"].tobytes())
+                vectors = data["vectors"].astype(np.float32)
+            for identity, vector, response_text in zip(identities, vectors, responses):
+                add_to_semantic_cache(identity, vector, response_text)
+        except:
+            semantic_cache.clear()
+
+def write_semantic_cache(entries):
+    """Write a snapshot of the semantic cache to file"""
+    identities, vectors, responses = [], [], []
+    for identity, (entry_vectors, entry_responses) in entries:
+        identities.extend([identity] * len(entry_responses))
+        vectors.append(entry_vectors)
+        responses.extend(entry_responses)
+    # Text goes in as JSON bytes since numpy string arrays pad every entry to the longest,
+    # and half precision is plenty for comparing against SEMANTIC_CACHE_THRESHOLD
+    texts = json.dumps([identities, responses]).encode()
+    # Write to a temporary file and rename so a crash never leaves a torn file
+    temp_file = f"{SEMANTIC_CACHE_FILE}.{os.getpid()}.tmp"
+    with open(temp_file, "wb") as f:
+        np.savez_compressed(
+            f,
+            texts=np.frombuffer(texts, dtype=np.uint8),
+            vectors=np.vstack(vectors).astype(np.float16)
+        )
+    os.replace(temp_file, SEMANTIC_CACHE_FILE)
+
+async def save_semantic_cache():
+    """Save cached embeddings and responses to file"""
+    if not semantic_cache:
+        return
+    # Entries are replaced rather than mutated, so a shallow copy is a consistent snapshot
+    await asyncio.to_thread(write_semantic_cache, list(semantic_cache.items()))
+
+async def save_semantic_cache_periodically():
+    """Save the semantic cache every SEMANTIC_CACHE_SAVE_INTERVAL seconds"""
+    while True:
+        await asyncio.sleep(SEMANTIC_CACHE_SAVE_INTERVAL)
+        try:
+            await save_semantic_cache()
+        except OSError:
+            pass
+
+@openai_retry
+async def embed_text(text: str):
+    """Return the unit-normalised embedding of a piece of text"""
+    response = await no_retry_client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+    vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+def lookup_semantic_cache(identity: str, vector):
+    """Return the cached email for the most similar text with the same identity, if similar enough"""
+    entry = semantic_cache.get(identity)
+    if entry is None:
+        return None
+    semantic_cache.move_to_end(identity)
+    entry_vectors, entry_responses = entry
+    # Vectors are normalised, so the dot product is the cosine similarity
+    similarities = entry_vectors @ vector
+    best = int(np.argmax(similarities))
+    if similarities[best] > SEMANTIC_CACHE_THRESHOLD:
+        return entry_responses[best]
+    return None
+
+def add_to_semantic_cache(identity: str, vector, response_text: str):
+    """Store an embedding and its generated email under an identity"""
+    entry = semantic_cache.get(identity)
+    if entry is None:
+        semantic_cache[identity] = (vector[np.newaxis, :], [response_text])
+        # Evict the least recently used identities beyond the cap
+        while len(semantic_cache) > SEMANTIC_CACHE_MAX_IDENTITIES:
+            semantic_cache.popitem(last=False)
+    else:
+        # Keep only the newest emails for each identity
+        entry_vectors, entry_responses = entry
+        semantic_cache[identity] = (
+            np.vstack([entry_vectors, vector])[-SEMANTIC_CACHE_MAX_PER_IDENTITY:],
+            (entry_responses + [response_text])[-SEMANTIC_CACHE_MAX_PER_IDENTITY:]
+        )
+        semantic_cache.move_to_end(identity)
+
+def build_prompt(request: EmailGenerationRequest):
+    """Build the email generation prompt for a request"""
+    return PROMPT_TEMPLATE.substitute(
+        sender_company=request.sender_company,
+        target_company=request.target_company,
+        industry=request.industry,
+        person_name=request.person_name,
+        role=request.role,
+        email_subject=request.email_subject,
+        tone=request.tone.lower(),
+        length=request.length.lower(),
+        custom_instructions=request.custom_instructions or ""
+    )
+
+def build_messages(prompt: str):
+    """Build the chat messages for an email generation prompt"""
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+
+def response_cache_key(prompt: str):
+    """Return the exact-match cache key for a prompt"""
+    return hashlib.sha256(f"{DEFAULT_AI_MODEL}|{DEFAULT_TEMPERATURE}|{SYSTEM_PROMPT}|{prompt}".encode()).hexdigest()
+
+@openai_retry
+async def create_chat_completion(prompt: str):
+    """Generate an email for a prompt within the OpenAI concurrency and rate limits"""
+    async with openai_semaphore, openai_limiter:
+        response = await no_retry_client.chat.completions.create(
+            model=DEFAULT_AI_MODEL,
+            messages=build_messages(prompt),
+            temperature=DEFAULT_TEMPERATURE
+        )
+    return response.choices[0].message.content.strip()
+
+@openai_retry
+async def open_chat_completion_stream(prompt: str):
+    """Start streaming an email for a prompt within the OpenAI concurrency and rate limits"""
+    # The limits only cover opening the stream, so slow readers don't hold a slot
+    async with openai_semaphore, openai_limiter:
+        return await no_retry_client.chat.completions.create(
+            model=DEFAULT_AI_MODEL,
+            messages=build_messages(prompt),
+            temperature=DEFAULT_TEMPERATURE,
+            stream=True
+        )
+
+async def lookup_cached_email(request: EmailGenerationRequest, cache_key: str):
+    """Return a cached email for a request, if any, and its embedding for caching a new one"""
+    # Reuse the email generated for an identical prompt if there is one
+    async with response_cache_lock:
+        response_text = response_cache.get(cache_key)
+    if response_text is not None:
+        return response_text, None
+    
+    # Fall back to the email generated for the same recipient with a near-identical subject
+    try:
+        text_vector = await embed_text(semantic_cache_text(request))
+        response_text = lookup_semantic_cache(semantic_cache_identity(request), text_vector)
+    except Exception as e:
+        # The cache is an optimisation, so generate normally if it's unavailable
+        logger.warning("Semantic cache lookup failed: %s", e)
+        return None, None
+    
+    if response_text is not None:
+        async with response_cache_lock:
+            response_cache[cache_key] = response_text
+    return response_text, text_vector
+
+async def cache_email(request: EmailGenerationRequest, cache_key: str, text_vector, response_text: str):
+    """Store a newly generated email in the caches"""
+    if text_vector is not None:
+        add_to_semantic_cache(semantic_cache_identity(request), text_vector, response_text)
+    async with response_cache_lock:
+        response_cache[cache_key] = response_text
+
+async def generate_email_text(request: EmailGenerationRequest):
+    """Return the email for a request, from the caches when possible"""
+    prompt = build_prompt(request)
+    cache_key = response_cache_key(prompt)
+    
+    response_text, text_vector = await lookup_cached_email(request, cache_key)
+    if response_text is None:
+        response_text = await create_chat_completion(prompt)
+        await cache_email(request, cache_key, text_vector, response_text)
+    return response_text
+
+def email_request_from_query(
+    sender_company: str,
+    target_company: str,
+    industry: str,
+    person_name: str,
+    role: str,
+    email_subject: str,
+    tone: str = "Professional",
+    length: str = "Concise",
+    custom_instructions: Optional[str] = None,
+    session_id: Optional[str] = None
+):
+    """Build an email generation request from query parameters, ignoring unknown ones"""
+    try:
+        return EmailGenerationRequest(
+            sender_company=sender_company,
+            target_company=target_company,
+            industry=industry,
+            person_name=person_name,
+            role=role,
+            email_subject=email_subject,
+            tone=tone,
+            length=length,
+            custom_instructions=custom_instructions,
+            session_id=session_id
+        )
+    except ValidationError as e:
+        raise RequestValidationError([{**error, "loc": ("query", *error["loc"])} for error in e.errors()])
+
 @app.get("/")
 async def root():
     return {"message": "Welcome to Sales Cold Email Generator"}
 
 @app.post("/api/email/generate", response_model=EmailResponse)
-async def generate_email(request: EmailGenerationRequest):
-    # Validate required fields
-    if not all([request.sender_company, request.target_company, 
-                request.person_name, request.role, request.email_subject]):
-        raise HTTPException(status_code=400, detail="All fields are required")
-    
+async def generate_email(request: EmailGenerationRequest, background_tasks: BackgroundTasks):
     # Generate or use provided session_id
-    session_id = request.session_id or str(random.randint(10000, 99999))
+    session_id = request.session_id or secrets.token_urlsafe(8)
     
-    # Check rate limits
-    can_proceed, limit_message = check_rate_limit(session_id)
+    # Check and increment rate limits
+    can_proceed, limit_message = await enforce_rate_limit(session_id)
     if not can_proceed:
         raise HTTPException(status_code=429, detail=limit_message)
     
-    # Increment rate limit counter
-    increment_rate_limit(session_id)
-    
-    # Construct the prompt
-    prompt = f"""
-You are an expert cold email copywriter and B2B personalization strategist.
-
-Write a highly personalized cold email from {request.sender_company} to {request.person_name}, the {request.role} at {request.target_company} in the {request.industry} industry, based on the following subject line:
-
-Subject: {request.email_subject}
-
-The email should:
-- Use a {request.tone.lower()} tone and be {request.length.lower()} in length
-- Start with a hook that's personalized and relevant to {request.target_company} and their industry
-- Explain how {request.sender_company}'s platform can solve pain points like lead qualification, demo personalization, or sales insights
-- Show why this is useful for someone in the role of {request.role}
-- Align with the theme of the subject line
-- End with a friendly CTA to continue the conversation
-
-{request.custom_instructions if request.custom_instructions else ""}
-
-Return only the email body. Do NOT include signature or re-state the subject.
-"""
-    
     # Generate the email using OpenAI
     try:
-        if not client:
-            raise HTTPException(status_code=500, detail="OpenAI API key is missing")
-        
-        try:
-            # Try the new OpenAI client approach first
-            response = client.chat.completions.create(
-                model=DEFAULT_AI_MODEL,
-                messages=[
-                    {"role": "system", "content": "You write persuasive and personalized B2B cold emails."},
-                    {"role": "user", "content": prompt}
-                ]
-            )
-            response_text = response.choices[0].message.content.strip()
-        except AttributeError:
-            # Fallback to the older API format
-            response = client.ChatCompletion.create(
-                model=DEFAULT_AI_MODEL,
-                messages=[
-                    {"role": "system", "content": "You write persuasive and personalized B2B cold emails."},
-                    {"role": "user", "content": prompt}
-                ]
-            )
-            response_text = response.choices[0].message.content.strip()
+        response_text = await generate_email_text(request)
         
-        # Save to history
-        email_id = f"{len(saved_emails) + 1}_{random.randint(1000, 9999)}"
-        saved_emails.append({
+        # Save to history after the response has been sent
+        email_id = secrets.token_hex(8)
+        background_tasks.add_task(persist_email, {
             "id": email_id,
-            "date": datetime.now().strftime("%Y-%m-%d %H:%M"),
             "recipient": request.person_name,
             "company": request.target_company,
             "subject": request.email_subject,
@@ -243,21 +618,274 @@ Return only the email body. Do NOT include signature or re-state the subject.
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating email: {str(e)}")
 
+@app.get("/api/email/generate/stream")
+async def generate_email_stream(request: EmailGenerationRequest = Depends(email_request_from_query)):
+    """Stream a generated email to the client as Server-Sent Events"""
+    # Generate or use provided session_id
+    session_id = request.session_id or secrets.token_urlsafe(8)
+    
+    # Check and increment rate limits
+    can_proceed, limit_message = await enforce_rate_limit(session_id)
+    if not can_proceed:
+        raise HTTPException(status_code=429, detail=limit_message)
+    
+    prompt = build_prompt(request)
+    cache_key = response_cache_key(prompt)
+    streamed = {}
+    
+    async def event_stream():
+        # Each event's data is a JSON string so newlines in the email can't break SSE framing
+        chunks = []
+        try:
+            cached_text, text_vector = await lookup_cached_email(request, cache_key)
+            
+            if cached_text is not None:
+                chunks.append(cached_text)
+                yield f"data: {json.dumps(cached_text)}\n\n"
+            else:
+                # Closing the stream on exit drops the connection if the client goes away
+                async with await open_chat_completion_stream(prompt) as stream:
+                    async for chunk in stream:
+                        content = chunk.choices[0].delta.content if chunk.choices else None
+                        if content:
+                            chunks.append(content)
+                            yield f"data: {json.dumps(content)}\n\n"
+        except Exception as e:
+            yield f"event: error\ndata: {json.dumps(f'Error generating email: {str(e)}')}\n\n"
+            return
+        
+        # Cache the assembled email before [DONE], since a client may disconnect
+        # as soon as it arrives and the rest of the generator would never run
+        response_text = "".join(chunks).strip()
+        if cached_text is None:
+            await cache_email(request, cache_key, text_vector, response_text)
+        streamed["email"] = {
+            "id": secrets.token_hex(8),
+            "recipient": request.person_name,
+            "company": request.target_company,
+            "subject": request.email_subject,
+            "content": response_text
+        }
+        yield "data: [DONE]\n\n"
+    
+    async def save_streamed_email():
+        # Background tasks still run after a disconnect, unlike the generator
+        if "email" in streamed:
+            await persist_email(streamed["email"])
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        background=BackgroundTask(save_streamed_email)
+    )
+
+@app.post("/api/email/generate_many", response_model=List[EmailResponse])
+async def generate_many_emails(
+    background_tasks: BackgroundTasks,
+    requests: List[EmailGenerationRequest] = Body(..., min_length=1, max_length=MAX_EMAILS_PER_CALL)
+):
+    """Generate several emails concurrently and return them in request order"""
+    # Count the whole call against one session, all or nothing
+    session_id = shared_session_id(requests)
+    now = int(time.time())
+    can_proceed, limit_message = await enforce_rate_limit(session_id, len(requests), now)
+    if not can_proceed:
+        raise HTTPException(status_code=429, detail=limit_message)
+    
+    tasks = [asyncio.ensure_future(generate_email_text(request)) for request in requests]
+    try:
+        responses = await asyncio.gather(*tasks)
+    except Exception as e:
+        # Nothing is returned on failure, so stop the other emails and uncount them all
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await refund_rate_limit(session_id, len(requests), now)
+        raise HTTPException(status_code=500, detail=f"Error generating emails: {str(e)}")
+    
+    # Save to history after the response has been sent
+    for request, response_text in zip(requests, responses):
+        background_tasks.add_task(persist_email, {
+            "id": secrets.token_hex(8),
+            "recipient": request.person_name,
+            "company": request.target_company,
+            "subject": request.email_subject,
+            "content": response_text
+        })
+    
+    return [
+        {"email_text": response_text, "subject": request.email_subject}
+        for request, response_text in zip(requests, responses)
+    ]
+
+@app.post("/api/email/generate/batch", response_model=BatchJobResponse)
+async def generate_email_batch(
+    requests: List[EmailGenerationRequest] = Body(..., min_length=1, max_length=MAX_EMAILS_PER_CALL)
+):
+    """Submit several emails to the OpenAI Batch API at half the per-token cost"""
+    # Count the whole call against one session, all or nothing
+    session_id = shared_session_id(requests)
+    now = int(time.time())
+    can_proceed, limit_message = await enforce_rate_limit(session_id, len(requests), now)
+    if not can_proceed:
+        raise HTTPException(status_code=429, detail=limit_message)
+    
+    # One chat completion per line, matched back up by custom_id
+    lines = [
+        json.dumps({
+            "custom_id": str(i),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": DEFAULT_AI_MODEL,
+                "messages": build_messages(build_prompt(request)),
+                "temperature": DEFAULT_TEMPERATURE
+            }
+        })
+        for i, request in enumerate(requests)
+    ]
+    
+    try:
+        batch_file = await client.files.create(
+            file=("emails.jsonl", "\n".join(lines).encode()),
+            purpose="batch"
+        )
+        batch = await client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+    except Exception as e:
+        # Nothing was submitted, so give the quota back
+        await refund_rate_limit(session_id, len(requests), now)
+        raise HTTPException(status_code=500, detail=f"Error submitting batch: {str(e)}")
+    
+    try:
+        await db.executemany(
+            "INSERT INTO batch_requests (batch_id, custom_id, recipient, company, subject) VALUES (?, ?, ?, ?, ?)",
+            [(batch.id, str(i), request.person_name, request.target_company, request.email_subject)
+             for i, request in enumerate(requests)]
+        )
+        await db.commit()
+    except Exception as e:
+        # Results can't be collected without these rows, so cancel the batch and give the quota back
+        await db.rollback()
+        try:
+            await client.batches.cancel(batch.id)
+        except Exception as cancel_error:
+            logger.warning("Failed to cancel unrecorded batch %s: %s", batch.id, cancel_error)
+        await refund_rate_limit(session_id, len(requests), now)
+        raise HTTPException(status_code=500, detail=f"Error saving batch: {str(e)}")
+    
+    return {"batch_id": batch.id, "status": batch.status}
+
+@app.get("/api/email/generate/batch/{batch_id}", response_model=BatchResultResponse)
+async def get_email_batch(batch_id: str, background_tasks: BackgroundTasks):
+    """Get the status of a batch, and its emails and failures once finished"""
+    async with db.execute(
+        "SELECT custom_id, recipient, company, subject FROM batch_requests WHERE batch_id = ?",
+        (batch_id,)
+    ) as cursor:
+        batch_requests = {row["custom_id"]: row for row in await cursor.fetchall()}
+    
+    if not batch_requests:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    
+    try:
+        batch = await client.batches.retrieve(batch_id)
+        if batch.status not in BATCH_FINISHED_STATUSES:
+            return {"batch_id": batch_id, "status": batch.status, "emails": []}
+        # Successful lines are in the output file and failed ones in the error file
+        lines = []
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                content = await client.files.content(file_id)
+                lines.extend(content.text.splitlines())
+    except NotFoundError:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error retrieving batch: {str(e)}")
+    
+    results, errors = {}, {}
+    for line in lines:
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        response = result.get("response")
+        if result.get("error") or not response or response["status_code"] != 200:
+            error = result.get("error") or (response or {}).get("body", {}).get("error") or {}
+            errors[result["custom_id"]] = error.get("message") or "Request failed"
+            continue
+        results[result["custom_id"]] = response["body"]["choices"][0]["message"]["content"].strip()
+    
+    emails = []
+    for custom_id in sorted(results, key=int):
+        request = batch_requests[custom_id]
+        # Ids are derived from the batch so polling again doesn't duplicate history
+        background_tasks.add_task(persist_email, {
+            "id": f"{batch_id}_{custom_id}",
+            "recipient": request["recipient"],
+            "company": request["company"],
+            "subject": request["subject"],
+            "content": results[custom_id]
+        })
+        emails.append({"email_text": results[custom_id], "subject": request["subject"]})
+    
+    # Lines left unprocessed by an expired or cancelled batch appear in neither file
+    failed = [
+        {
+            "index": int(custom_id),
+            "subject": request["subject"],
+            "error": errors.get(custom_id, f"No result, batch {batch.status}")
+        }
+        for custom_id, request in sorted(batch_requests.items(), key=lambda item: int(item[0]))
+        if custom_id not in results
+    ]
+    
+    return {"batch_id": batch_id, "status": batch.status, "emails": emails, "failed": failed}
+
 @app.get("/api/emails/saved", response_model=List[SavedEmail])
-async def get_saved_emails(limit: int = 50, offset: int = 0):
+async def get_saved_emails(
+    response: Response,
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0),
+    cursor: Optional[str] = None
+):
     """Get list of saved emails"""
-    start = min(offset, len(saved_emails))
-    end = min(offset + limit, len(saved_emails))
-    return saved_emails[start:end]
+    # Full pages set X-Next-Cursor; passing it back as cursor seeks on
+    # (created_ts, id) through the index instead of scanning past an offset
+    if cursor is not None:
+        created_ts, _, email_id = cursor.partition("_")
+        try:
+            created_ts = float(created_ts)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = "WHERE (created_ts, id) > (?, ?) ORDER BY created_ts, id LIMIT ?"
+        params = (created_ts, email_id, limit)
+    else:
+        query, params = "ORDER BY created_ts, id LIMIT ? OFFSET ?", (limit, offset)
+    
+    async with db.execute(
+        "SELECT id, date, recipient, company, subject, content, created_ts FROM emails " + query,
+        params
+    ) as db_cursor:
+        rows = await db_cursor.fetchall()
+    
+    if len(rows) == limit:
+        response.headers["X-Next-Cursor"] = f"{rows[-1]['created_ts']!r}_{rows[-1]['id']}"
+    
+    return [
+        {key: row[key] for key in ("id", "date", "recipient", "company", "subject", "content")}
+        for row in rows
+    ]
 
 @app.delete("/api/emails/{email_id}")
 async def delete_email(email_id: str):
     """Delete a saved email by ID"""
-    global saved_emails
-    original_count = len(saved_emails)
-    saved_emails = [email for email in saved_emails if email["id"] != email_id]
+    cursor = await db.execute("DELETE FROM emails WHERE id = ?", (email_id,))
+    await db.commit()
     
-    if len(saved_emails) == original_count:
+    if cursor.rowcount == 0:
         raise HTTPException(status_code=404, detail="Email not found")
     
     return {"message": "Email deleted successfully"}
@@ -265,7 +893,15 @@ async def delete_email(email_id: str):
 @app.get("/api/analytics")
 async def get_analytics():
     """Get email generation analytics"""
-    if not saved_emails:
+    # Calculate total, weekly and average length in a single scan
+    one_week_ago = time.time() - 7 * 86400
+    async with db.execute(
+        "SELECT COUNT(*), SUM(created_ts > ?), AVG(word_count) FROM emails",
+        (one_week_ago,)
+    ) as cursor:
+        total_emails, weekly_emails, avg_length = await cursor.fetchone()
+    
+    if not total_emails:
         return {
             "total_emails": 0,
             "weekly_emails": 0,
@@ -274,65 +910,39 @@ async def get_analytics():
             "top_companies": []
         }
     
-    # Calculate basic metrics
-    total_emails = len(saved_emails)
-    
-    # Calculate weekly emails
-    today = datetime.now()
-    one_week_ago = today - timedelta(days=7)
-    weekly_emails = 0
-    
-    for email in saved_emails:
-        try:
-            email_date = datetime.strptime(email['date'], "%Y-%m-%d %H:%M")
-            if email_date > one_week_ago:
-                weekly_emails += 1
-        except:
-            pass
-    
-    # Calculate average length
-    total_words = 0
-    for email in saved_emails:
-        total_words += len(email['content'].split())
-    
-    avg_length = total_words // max(1, len(saved_emails))
-    
     # Calculate emails over time
-    dates = []
-    for email in saved_emails:
-        try:
-            email_date = datetime.strptime(email['date'], "%Y-%m-%d %H:%M")
-            dates.append(email_date.date().strftime("%Y-%m-%d"))
-        except:
-            pass
-    
-    # Count occurrences of each date
-    date_counts = {}
-    for date in dates:
-        date_counts[date] = date_counts.get(date, 0) + 1
-    
-    email_over_time = [{"date": date, "count": count} for date, count in date_counts.items()]
+    async with db.execute(
+        "SELECT day, COUNT(*) FROM emails GROUP BY day ORDER BY day"
+    ) as cursor:
+        email_over_time = [{"date": date, "count": count} for date, count in await cursor.fetchall()]
     
     # Calculate top companies
-    companies = [email['company'] for email in saved_emails]
-    company_counts = {}
-    
-    for company in companies:
-        company_counts[company] = company_counts.get(company, 0) + 1
-    
-    top_companies = [{"company": company, "count": count} 
-                     for company, count in sorted(company_counts.items(), 
-                                                key=lambda x: x[1], 
-                                                reverse=True)][:10]
+    async with db.execute(
+        "SELECT company, COUNT(*) c FROM emails GROUP BY company ORDER BY c DESC LIMIT 10"
+    ) as cursor:
+        top_companies = [{"company": company, "count": count} for company, count in await cursor.fetchall()]
     
     return {
         "total_emails": total_emails,
         "weekly_emails": weekly_emails,
-        "avg_length": avg_length,
+        "avg_length": int(avg_length),
         "email_over_time": email_over_time,
         "top_companies": top_companies
     }
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
+    # Workers are separate processes; the JSON-file rate limiter isn't safe
+    # across processes, so more than one worker requires Redis
+    default_workers = (os.cpu_count() or 1) if REDIS_URL else 1
+    workers = int(os.getenv("WEB_CONCURRENCY", default_workers))
+    if workers > 1 and not REDIS_URL:
+        raise ValueError("REDIS_URL is required to run more than one worker")
+    uvicorn.run(
+        "api:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=workers,
+        loop="uvloop",
+        http="httptools"
+    ) 
\ No newline at end of file